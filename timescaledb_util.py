@@ -1,6 +1,9 @@
+import functools
+import io
 import pandas as pd
+import psycopg2.extras
 from decimal import Decimal
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 
 class TimeScaleDBUtil:
@@ -19,6 +22,17 @@ class TimeScaleDBUtil:
     database : str, 必須
         TimeScaleDBのデータベース名。
     """
+    # 約定履歴テーブルの列定義(NUMERIC列はSQL側でtextにキャストしてDecimalを直接構築する)
+    _TRADE_META_COLUMNS = ('datetime', 'id', 'side', 'liquidation')
+    _TRADE_NUMERIC_COLUMNS = ('price', 'volume', 'dollar_volume', 'dollar_cumsum', 'dollar_buy_cumsum', 'dollar_sell_cumsum')
+    # バーテーブルの列定義(NUMERIC列はfloat読みとDecimal読みの切り替えに使う)
+    _BAR_META_COLUMNS = ('datetime', 'datetime_from', 'id', 'id_from')
+    _BAR_NUMERIC_COLUMNS = ('open', 'high', 'low', 'close', 'volume', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume', 'dollar_cumsum', 'dollar_buy_cumsum', 'dollar_sell_cumsum')
+    # テーブル定義(3つのinit_*で共有するDDL部品)
+    _TRADE_TABLE_COLUMNS = ('datetime TIMESTAMP WITH TIME ZONE NOT NULL', 'id text', 'side enum_side NOT NULL', 'liquidation BOOL NOT NULL', 'price NUMERIC NOT NULL', 'volume NUMERIC NOT NULL', 'dollar_volume NUMERIC NOT NULL', 'dollar_cumsum NUMERIC NOT NULL', 'dollar_buy_cumsum NUMERIC NOT NULL', 'dollar_sell_cumsum NUMERIC NOT NULL')
+    _BAR_TABLE_COLUMNS = ('datetime TIMESTAMP WITH TIME ZONE NOT NULL', 'datetime_from TIMESTAMP WITH TIME ZONE NOT NULL', 'id text', 'id_from text', 'open NUMERIC NOT NULL', 'high NUMERIC NOT NULL', 'low NUMERIC NOT NULL', 'close NUMERIC NOT NULL', 'volume NUMERIC NOT NULL', 'dollar_volume NUMERIC NOT NULL', 'dollar_buy_volume NUMERIC NOT NULL', 'dollar_sell_volume NUMERIC NOT NULL', 'dollar_liquidation_volume NUMERIC NOT NULL', 'dollar_liquidation_buy_volume NUMERIC NOT NULL', 'dollar_liquidation_sell_volume NUMERIC NOT NULL', 'dollar_cumsum NUMERIC NOT NULL', 'dollar_buy_cumsum NUMERIC NOT NULL', 'dollar_sell_cumsum NUMERIC NOT NULL')
+    _LOAD_BAR_COLUMNS = ('datetime', 'open', 'high', 'low', 'close', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume', 'dollar_cumsum', 'dollar_buy_cumsum', 'dollar_sell_cumsum')
+
     def __init__(self, user = None, password = None, host = None, port = None, database = None):
         if user == None:
             raise ValueError(f'TimeScaleDBのユーザー名を指定してください')
@@ -32,14 +46,22 @@ class TimeScaleDBUtil:
             raise ValueError(f'TimeScaleDBのデータベース名を指定してください')
         
         _sqlalchemy_config = f'postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}'
-        self._engine = create_engine(_sqlalchemy_config)
-        
+        # LIFOで直近の接続を使い回してサーバ側キャッシュを温かく保ち、statement_timeoutで最悪ケースのハングを抑える
+        self._engine = create_engine(_sqlalchemy_config, pool_size = 5, max_overflow = 10, pool_pre_ping = True, pool_use_lifo = True, pool_recycle = 1800, connect_args = {'options': '-c statement_timeout=30000'})
+
+        # getter系クエリのtext()構築をテーブルごとにキャッシュし、SQLAlchemyのコンパイル済みステートメントキャッシュを効かせる
+        self._select_statements = {}
+
+        # テーブルの存在確認を毎回information_schemaに問い合わせないよう、既知のテーブル名をキャッシュしておく
+        with self._engine.connect() as _connection:
+            self._known_tables = {_row[0] for _row in _connection.execute(text("SELECT relname FROM pg_catalog.pg_class WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace"))}
+
         # enum_side型がデータベース上に存在することを確認し、ない場合は作成する
         _df = self.read_sql_query("SELECT * from pg_type WHERE typname='enum_side'")
-        if _df.empty == True:
+        if _df.empty:
             self.sql_execute("CREATE TYPE enum_side AS ENUM ('buy', 'sell')")
 
-    def read_sql_query(self, sql = None, index_column = '', dtype={}):
+    def read_sql_query(self, sql = None, index_column = '', dtype={}, params=None, chunksize=None):
         """
         指定されたSQLを実行し、結果をデータフレームで返す関数
         パラメータ
@@ -49,6 +71,10 @@ class TimeScaleDBUtil:
         index_column : str, default = ''
             出力するデータフレームのインデックスにする列名。
         dtype : dict, default = {}
+        params : dict, default = None
+            SQL文中のバインドパラメータに渡す値。
+        chunksize : int, default = None
+            指定した場合、結果をこの行数ずつ読み込んで最後に連結する(デコード中のピークメモリを抑える)。
         返り値
         -------
         df : pandas.DataFrame
@@ -56,33 +82,56 @@ class TimeScaleDBUtil:
         """
         if sql == None:
             raise ValueError(f'実行するSQL文を指定してください')
-        if hasattr(self, '_engine') == False:
+        if not hasattr(self, '_engine'):
             raise UnboundLocalError('SQLAlchemyが初期化されていません')
         
-        df = pd.read_sql_query(sql, self._engine, dtype=dtype)
-        if len(index_column) > 0:
+        if chunksize is None:
+            df = pd.read_sql_query(sql, self._engine, dtype=dtype, params=params)
+        else:
+            # chunksize指定時はサーバーサイドカーソルで流し、ドライバが全結果を先読みバッファしないようにする
+            # 大きい範囲の読み込みはエンジン全体の30秒statement_timeoutの対象外にする(LOCALなのでこのトランザクション限り)
+            with self._engine.connect().execution_options(stream_results = True) as _connection:
+                with _connection.begin():
+                    _connection.execute(text('SET LOCAL statement_timeout = 0'))
+                    _chunks = list(pd.read_sql_query(sql, _connection, dtype=dtype, params=params, chunksize=chunksize))
+            df = pd.concat(_chunks, ignore_index = True, copy = False) if _chunks else pd.DataFrame()
+        if index_column:
             df = df.set_index(index_column, drop = True)
         return df
     
     def sql_execute(self, sql = None):
         """
-        指定されたSQLを実行し、結果をlistで返す関数
+        指定されたSQL(文字列あるいは文字列のリスト)を実行する関数
+        複数文は1つのトランザクションにまとめ、文ごとのBEGIN/COMMITラウンドトリップを省く
         パラメータ
         ----------
-        sql : str, 必須
-            実行するSQL文。
+        sql : str または list, 必須
+            実行するSQL文、あるいはSQL文のリスト。
         返り値
         -------
-        SQLクエリ結果を含んだdict。
+        最後に実行した文が行を返す場合はその行のlist、返さない場合はNone。
         """
         if sql == None:
             raise ValueError(f'実行するSQL文を指定してください')
-        if hasattr(self, '_engine') == False:
+        if not hasattr(self, '_engine'):
             raise UnboundLocalError('SQLAlchemyが初期化されていません')
-        
-        return self._engine.execute(sql)
+
+        # 文字列・text()いずれの単体引数もリストに正規化する
+        if not isinstance(sql, list):
+            sql = [sql]
+        if len(sql) == 0:
+            raise ValueError(f'実行するSQL文を指定してください')
+
+        # コミット後は結果がフェッチできなくなるため、トランザクション内で行を取り出しておく
+        _rows = None
+        with self._engine.begin() as _connection:
+            for _statement in sql:
+                _result = _connection.execute(text(_statement) if isinstance(_statement, str) else _statement)
+            if _result.returns_rows:
+                _rows = _result.fetchall()
+        return _rows
     
-    def df_to_sql(self, df = None, schema = None, if_exists = 'fail'):
+    def df_to_sql(self, df = None, schema = None, if_exists = 'fail', method = 'copy'):
         """
         指定されたデータフレームをSQLデータベースに追加して結果を返す関数
         パラメータ
@@ -91,184 +140,380 @@ class TimeScaleDBUtil:
             データベースに追加するデータを含んだデータフレーム
         schema : str, 必須
             データベースのスキーマ名
+        method : str, default = 'copy'
+            書き込み方式。'copy'はCOPY、'values'はexecute_valuesによる複数行INSERT。
         返り値
         -------
         Noneあるいは変更された行数。
         """
-        if df.empty or schema == None:
-            return  
-        return df.to_sql(schema, con = self._engine, if_exists = if_exists, index = False)
+        if df is None or df.empty or schema == None:
+            return
+
+        # テーブル作成や置き換えのDDLはto_sqlに任せ、データ本体はCOPYで流し込む
+        if schema not in self._known_tables or if_exists == 'replace':
+            df.head(0).to_sql(schema, con = self._engine, if_exists = if_exists, index = False)
+            self._known_tables.add(schema)
+        elif if_exists == 'fail':
+            raise ValueError(f'テーブル {schema} は既に存在します')
+
+        # COPYが使えない環境向けのフォールバック
+        if method == 'values':
+            return self._upsert(df, schema)
+
+        _columns = ', '.join([f'"{_column}"' for _column in df.columns])
+        _buffer = io.StringIO()
+        df.to_csv(_buffer, index = False, header = False, na_rep = '')
+        _buffer.seek(0)
+
+        # UNIQUE制約と衝突する行を捨てられるよう、一時テーブルにCOPYしてからINSERTする
+        _connection = self._engine.raw_connection()
+        try:
+            with _connection.cursor() as _cursor:
+                # 一括ロードはエンジン全体の30秒statement_timeoutの対象外にする(LOCALなのでこのトランザクション限り)
+                _cursor.execute('SET LOCAL statement_timeout = 0')
+                _cursor.execute(f'CREATE TEMP TABLE "_copy_{schema}" (LIKE "{schema}") ON COMMIT DROP')
+                _cursor.copy_expert(f'COPY "_copy_{schema}" ({_columns}) FROM STDIN WITH CSV', _buffer)
+                _cursor.execute(f'INSERT INTO "{schema}" ({_columns}) SELECT {_columns} FROM "_copy_{schema}" ON CONFLICT DO NOTHING')
+                _rowcount = _cursor.rowcount
+            _connection.commit()
+        except:
+            _connection.rollback()
+            raise
+        finally:
+            _connection.close()
+        return _rowcount
     
+    def _upsert(self, df, table, conflict_columns=None):
+        """
+        execute_valuesの複数行INSERTでデータフレームを書き込む関数
+        COPYが使えない場合のフォールバックで、1行ずつのexecutemanyよりラウンドトリップが大幅に少ない
+        パラメータ
+        ----------
+        df : pandas.DataFrame, 必須
+            書き込むデータを含んだデータフレーム。
+        table : str, 必須
+            書き込み先のテーブル名。
+        conflict_columns : list, default = None
+            ON CONFLICT対象の列名のリスト。Noneの場合は全UNIQUE制約との衝突を無視する。
+        返り値
+        -------
+        挿入された行数。
+        """
+        _columns = ', '.join([f'"{_column}"' for _column in df.columns])
+        _conflict = f" ON CONFLICT ({', '.join(conflict_columns)}) DO NOTHING" if conflict_columns else ' ON CONFLICT DO NOTHING'
+        _rows = list(df.itertuples(index = False, name = None))
+
+        _connection = self._engine.raw_connection()
+        try:
+            with _connection.cursor() as _cursor:
+                # 一括ロードはエンジン全体の30秒statement_timeoutの対象外にする(LOCALなのでこのトランザクション限り)
+                _cursor.execute('SET LOCAL statement_timeout = 0')
+                # rowcountは最後のINSERTしか反映しないため、全行を1ページにまとめて1文で送る
+                psycopg2.extras.execute_values(_cursor, f'INSERT INTO "{table}" ({_columns}) VALUES %s{_conflict}', _rows, page_size = max(len(_rows), 1))
+                _rowcount = _cursor.rowcount
+            _connection.commit()
+        except:
+            _connection.rollback()
+            raise
+        finally:
+            _connection.close()
+        return _rowcount
+
+    def _decimalize(self, data, columns):
+        """
+        指定された列をまとめてDecimalに変換する関数
+        Series.applyのPython呼び出しオーバーヘッドを避け、リスト内包で一括変換する
+        パラメータ
+        ----------
+        data : pandas.DataFrame または pandas.Series, 必須
+            変換対象のデータ。
+        columns : list, 必須
+            Decimalに変換する列名のリスト。
+        返り値
+        -------
+        変換後のdata。
+        """
+        if isinstance(data, pd.DataFrame):
+            for _column in columns:
+                data[_column] = [Decimal(str(_value)) for _value in data[_column].values]
+        else:
+            for _column in columns:
+                data[_column] = Decimal(str(data[_column]))
+        return data
+
+    def _is_table_exist(self, table_name):
+        """
+        テーブルの存在を確認する関数
+        まず_known_tablesのキャッシュを引き、外れた場合だけto_regclassの定数時間カタログ参照で確認する
+        (information_schema.tablesのような複数カタログをJOINするビューのスキャンを避ける)
+        """
+        if table_name in self._known_tables:
+            return True
+
+        with self._engine.connect() as _connection:
+            _exists = _connection.execute(text('SELECT to_regclass(:table_name) IS NOT NULL'), {'table_name': f'public."{table_name}"'}).scalar()
+        if _exists:
+            self._known_tables.add(table_name)
+        return _exists
+
+    def _init_table(self, table_name, columns, unique_columns, chunk_time_interval):
+        """
+        テーブルとハイパーテーブルを作成する関数
+        DROP/CREATE/create_hypertableをDOブロックにまとめ、サーバーとのラウンドトリップとparse/planを1回にする
+        パラメータ
+        ----------
+        table_name : str, 必須
+            作成するテーブル名。
+        columns : tuple, 必須
+            '列名 型 制約'形式の列定義のタプル。
+        unique_columns : tuple, 必須
+            UNIQUE制約の対象列名のタプル。
+        chunk_time_interval : str, 必須
+            create_hypertableに渡すチャンク間隔。
+        """
+        _sql = (f'DO $$ BEGIN'
+                f' DROP TABLE IF EXISTS "{table_name}" CASCADE;'
+                f' CREATE TABLE IF NOT EXISTS "{table_name}" ({", ".join(columns)}, UNIQUE({", ".join(unique_columns)}));'
+                f" PERFORM create_hypertable ('{table_name}', 'datetime', chunk_time_interval => INTERVAL '{chunk_time_interval}');"
+                f' END $$;')
+        self.sql_execute(_sql)
+        self._known_tables.add(table_name)
+
+    def _create_secondary_index(self, table_name):
+        """
+        (datetime DESC, dollar_cumsum)の二次インデックスを作成する関数
+        ハイパーテーブルはCREATE INDEX CONCURRENTLYをサポートしないため、
+        transaction_per_chunkでチャンクごとにロックを取りながら作成する(自前でトランザクションを
+        制御するためAUTOCOMMITの接続で実行する)
+        datetime単体のインデックスはcreate_hypertableが作成するものをそのまま使う
+        """
+        _connection = self._engine.connect().execution_options(isolation_level = 'AUTOCOMMIT')
+        try:
+            # エンジン全体の30秒statement_timeoutはバックフィル後のインデックス構築には短すぎるため、この接続では外す
+            _connection.execute(text('SET statement_timeout = 0'))
+            _connection.execute(text(f'CREATE INDEX IF NOT EXISTS "{table_name}_datetime_dollar_cumsum_idx" ON "{table_name}" (datetime DESC, dollar_cumsum) WITH (timescaledb.transaction_per_chunk)'))
+        finally:
+            # AUTOCOMMITのセッション設定はプールに残るため、返却前に接続時のデフォルトへ戻す
+            _connection.execute(text('RESET statement_timeout'))
+            _connection.close()
+
     ### 約定履歴テーブル関係の処理
-    def get_trade_table_name(self, exchange, symbol):
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def get_trade_table_name(exchange, symbol):
         return (f'{exchange}_{symbol}_trade').lower()
     
-    def init_trade_table(self, exchange='binance', symbol='BTC/USDT', force=False):    
+    def init_trade_table(self, exchange='binance', symbol='BTC/USDT', force=False, chunk_time_interval='1 day'):
         _table_name = self.get_trade_table_name(exchange, symbol)
-        
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == False and force == False:
+
+        if self._is_table_exist(_table_name) and not force:
             return
         
         # トレード記録テーブルを作成
-        _sql = (f'DROP TABLE IF EXISTS "{_table_name}" CASCADE;'
-                f' CREATE TABLE IF NOT EXISTS "{_table_name}" (datetime TIMESTAMP WITH TIME ZONE NOT NULL, id text, side enum_side NOT NULL, liquidation BOOL NOT NULL, price NUMERIC NOT NULL, volume NUMERIC NOT NULL, dollar_volume NUMERIC NOT NULL, dollar_cumsum NUMERIC NOT NULL, dollar_buy_cumsum NUMERIC NOT NULL, dollar_sell_cumsum NUMERIC NOT NULL, UNIQUE(datetime, id));'
-                f' CREATE INDEX ON "{_table_name}" (datetime DESC);'
-                f' CREATE INDEX ON "{_table_name}" (datetime DESC, dollar_cumsum);'
-                f" SELECT create_hypertable ('{_table_name}', 'datetime');")
-        self.sql_execute(_sql)
-        
-        # 累積出来高記録用Maerialized viewを作成
-        _sql = (f'DROP MATERIALIZED VIEW IF EXISTS "{_table_name}_dollar_cumsum_daily" CASCADE;'
-                f'CREATE MATERIALIZED VIEW "{_table_name}_dollar_cumsum_daily" WITH (timescaledb.continuous) AS SELECT time_bucket(INTERVAL "1 day", datetime) AS time, MAX(dollar_cumsum) AS dollar_cumsum, MAX(dollar_buy_cumsum) AS dollar_buy_cumsum, MAX(dollar_sell_cumsum) AS dollar_sell_cumsum, LAST(price, datetime) AS close FROM "{_table_mane}" GROUP BY time WITH NO DATA')
-        self.sql_execute(_sql)
+        self._init_table(_table_name, self._TRADE_TABLE_COLUMNS, ('datetime', 'id'), chunk_time_interval)
+
+        # 累積出来高記録用の連続集計を作成
+        self.sql_execute(f'DROP MATERIALIZED VIEW IF EXISTS "{_table_name}_dollar_cumsum_daily" CASCADE')
+
+        # 連続集計の作成はトランザクション内で実行できないため、AUTOCOMMITの接続で実行する
+        _connection = self._engine.connect().execution_options(isolation_level = 'AUTOCOMMIT')
+        try:
+            _connection.execute(text(f'CREATE MATERIALIZED VIEW "{_table_name}_dollar_cumsum_daily" WITH (timescaledb.continuous) AS SELECT time_bucket(INTERVAL \'1 day\', datetime) AS time, MAX(dollar_cumsum) AS dollar_cumsum, MAX(dollar_buy_cumsum) AS dollar_buy_cumsum, MAX(dollar_sell_cumsum) AS dollar_sell_cumsum, LAST(price, datetime) AS close FROM "{_table_name}" GROUP BY time WITH NO DATA'))
+            # 1時間ごとに増分リフレッシュし、参照時に生のハイパーテーブルを再集計せずに済むようにする
+            _connection.execute(text(f"SELECT add_continuous_aggregate_policy('{_table_name}_dollar_cumsum_daily', start_offset => INTERVAL '3 days', end_offset => INTERVAL '1 hour', schedule_interval => INTERVAL '1 hour')"))
+        finally:
+            _connection.close()
         
+    def finalize_trade_table(self, exchange='binance', symbol='BTC/USDT'):
+        """
+        約定履歴テーブルの二次インデックスを作成する関数
+        一括ロード中の行ごとのインデックス更新を避けるため、バックフィル完了後に呼び出す
+        """
+        _table_name = self.get_trade_table_name(exchange, symbol)
+        self._create_secondary_index(_table_name)
+
     def get_latest_trade(self, exchange='ftx', symbol='BTC-PERP'):
         _table_name = self.get_trade_table_name(exchange, symbol)
         
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == True:
+        if not self._is_table_exist(_table_name):
             return None
         
-        _df = self.read_sql_query(f'WITH time_filtered AS (SELECT * FROM "{_table_name}" ORDER BY datetime DESC LIMIT 1000) SELECT * FROM time_filtered ORDER BY dollar_cumsum DESC LIMIT 1', dtype={'price': str, 'volume': str, 'dollar_volume': str, 'dollar_cumsum': str, 'dollar_buy_cumsum': str, 'dollar_sell_cumsum': str})
-        if len(_df) > 0:
-            _to_decimal = lambda x: Decimal(x)
-            _df['price'] = _df['price'].apply(_to_decimal)
-            _df['volume'] = _df['volume'].apply(_to_decimal)
-            _df['volume'] = _df['volume'].apply(_to_decimal)
-            _df['dollar_cumsum'] = _df['dollar_cumsum'].apply(_to_decimal)
-            _df['dollar_buy_cumsum'] = _df['dollar_buy_cumsum'].apply(_to_decimal)
-            _df['dollar_sell_cumsum'] = _df['dollar_sell_cumsum'].apply(_to_decimal)
-            return _df.iloc[0]
-        
-        return None
+        # 1行しか使わないのでデータフレームを経由せず直接フェッチする
+        _statement = self._select_statements.get(('latest_trade', _table_name))
+        if _statement is None:
+            # NUMERIC列はSQL側でtextにキャストし、ドライバのDecimal化を挟まずサーバ整形済み文字列から直接Decimalを構築する
+            _select_columns = ', '.join(self._TRADE_META_COLUMNS + tuple(f'{_column}::text AS {_column}' for _column in self._TRADE_NUMERIC_COLUMNS))
+            _statement = text(f'WITH time_filtered AS (SELECT * FROM "{_table_name}" ORDER BY datetime DESC LIMIT 1000) SELECT {_select_columns} FROM time_filtered ORDER BY time_filtered.dollar_cumsum DESC LIMIT 1')
+            self._select_statements[('latest_trade', _table_name)] = _statement
+        with self._engine.connect() as _connection:
+            _row = _connection.execute(_statement).fetchone()
+        if _row is None:
+            return None
+
+        _series = pd.Series(dict(_row))
+        return self._decimalize(_series, self._TRADE_NUMERIC_COLUMNS)
     
     def get_first_trade(self, exchange='ftx', symbol='BTC-PERP'):
         _table_name = self.get_trade_table_name(exchange, symbol)
         
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == True:
+        if not self._is_table_exist(_table_name):
             return None
         
-        _df = self.read_sql_query(f'WITH time_filtered AS (SELECT * FROM "{_table_name}" ORDER BY datetime ASC LIMIT 1000) SELECT * FROM time_filtered ORDER BY dollar_cumsum ASC LIMIT 1', dtype={'price': str, 'volume': str, 'dollar': str, 'dollar_cumsum': str})
-        if len(_df) > 0:
-            _to_decimal = lambda x: Decimal(x)
-            _df['price'] = _df['price'].apply(_to_decimal)
-            _df['volume'] = _df['volume'].apply(_to_decimal)
-            _df['dollar_volume'] = _df['dollar_volume'].apply(_to_decimal)
-            _df['dollar_cumsum'] = _df['dollar_cumsum'].apply(_to_decimal)
-            _df['dollar_buy_cumsum'] = _df['dollar_buy_cumsum'].apply(_to_decimal)
-            _df['dollar_sell_cumsum'] = _df['dollar_sell_cumsum'].apply(_to_decimal)
-            return _df.iloc[0]
-        
-        return None
+        # 1行しか使わないのでデータフレームを経由せず直接フェッチする
+        _statement = self._select_statements.get(('first_trade', _table_name))
+        if _statement is None:
+            # NUMERIC列はSQL側でtextにキャストし、ドライバのDecimal化を挟まずサーバ整形済み文字列から直接Decimalを構築する
+            _select_columns = ', '.join(self._TRADE_META_COLUMNS + tuple(f'{_column}::text AS {_column}' for _column in self._TRADE_NUMERIC_COLUMNS))
+            _statement = text(f'WITH time_filtered AS (SELECT * FROM "{_table_name}" ORDER BY datetime ASC LIMIT 1000) SELECT {_select_columns} FROM time_filtered ORDER BY time_filtered.dollar_cumsum ASC LIMIT 1')
+            self._select_statements[('first_trade', _table_name)] = _statement
+        with self._engine.connect() as _connection:
+            _row = _connection.execute(_statement).fetchone()
+        if _row is None:
+            return None
+
+        _series = pd.Series(dict(_row))
+        return self._decimalize(_series, self._TRADE_NUMERIC_COLUMNS)
     
     ### ドルバーテーブル関係の処理
-    def get_dollarbar_table_name(self, exchange, symbol, interval):
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def get_dollarbar_table_name(exchange, symbol, interval):
         return (f'{exchange}_{symbol}_dollarbar_{interval}').lower()
     
-    def init_dollarbar_table(self, exchange='ftx', symbol='BTC-PERP', interval=10_000_000, force=False):    
+    def init_dollarbar_table(self, exchange='ftx', symbol='BTC-PERP', interval=10_000_000, force=False, chunk_time_interval='7 days'):    
         _table_name = self.get_dollarbar_table_name(exchange, symbol, interval)
         
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == False and force == False:
+        if self._is_table_exist(_table_name) and not force:
             return
         
         # ドルバー記録テーブルを作成
-        _sql = (f'DROP TABLE IF EXISTS "{_table_name}" CASCADE;'
-                f' CREATE TABLE IF NOT EXISTS "{_table_name}" (datetime TIMESTAMP WITH TIME ZONE NOT NULL, datetime_from TIMESTAMP WITH TIME ZONE NOT NULL, id text, id_from text, open NUMERIC NOT NULL, high NUMERIC NOT NULL, low NUMERIC NOT NULL, close NUMERIC NOT NULL, volume NUMERIC NOT NULL, dollar_volume NUMERIC NOT NULL, dollar_buy_volume NUMERIC NOT NULL, dollar_sell_volume NUMERIC NOT NULL,  dollar_liquidation_volume NUMERIC NOT NULL, dollar_liquidation_buy_volume NUMERIC NOT NULL, dollar_liquidation_sell_volume NUMERIC NOT NULL, dollar_cumsum NUMERIC NOT NULL, dollar_buy_cumsum NUMERIC NOT NULL, dollar_sell_cumsum NUMERIC NOT NULL, UNIQUE(datetime, id));'
-                f' CREATE INDEX ON "{_table_name}" (datetime DESC);'
-                f' CREATE INDEX ON "{_table_name}" (datetime DESC, dollar_cumsum);'
-                f" SELECT create_hypertable ('{_table_name}', 'datetime');")
-        self.sql_execute(_sql)
-        
-    def get_latest_dollarbar(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000):
+        self._init_table(_table_name, self._BAR_TABLE_COLUMNS, ('datetime', 'id'), chunk_time_interval)
+
+    def finalize_dollarbar_table(self, exchange='ftx', symbol='BTC-PERP', interval=10_000_000):
+        """
+        ドルバーテーブルの二次インデックスを作成する関数
+        一括ロード中の行ごとのインデックス更新を避けるため、バックフィル完了後に呼び出す
+        """
+        _table_name = self.get_dollarbar_table_name(exchange, symbol, interval)
+        self._create_secondary_index(_table_name)
+
+    def get_latest_dollarbar(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000, numeric_as='float'):
         _table_name = self.get_dollarbar_table_name(exchange, symbol, interval)
         
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == True:
+        if not self._is_table_exist(_table_name):
             return None
         
-        _df = self.read_sql_query(f'SELECT * FROM "{_table_name}" ORDER BY datetime DESC, id DESC LIMIT 1', dtype={'open': str, 'high': str, 'low': str, 'close': str, 'volume': str, 'dollar_volume': str, 'dollar_buy_volume': str, 'dollar_sell_volume': str, 'dollar_liquidation_buy_volume': str, 'dollar_liquidation_sell_volume': str, 'dollar_cumsum': str})
-        if len(_df) > 0:
-            _to_decimal = lambda x: Decimal(x)
-            _df['open'] = _df['open'].apply(_to_decimal)
-            _df['high'] = _df['high'].apply(_to_decimal)
-            _df['low'] = _df['low'].apply(_to_decimal)
-            _df['close'] = _df['close'].apply(_to_decimal)
-            _df['volume'] = _df['volume'].apply(_to_decimal)
-            _df['dollar_volume'] = _df['dollar_volume'].apply(_to_decimal)
-            _df['dollar_buy_volume'] = _df['dollar_buy_volume'].apply(_to_decimal)
-            _df['dollar_sell_volume'] = _df['dollar_sell_volume'].apply(_to_decimal)
-            _df['dollar_liquidation_volume'] = _df['dollar_liquidation_volume'].apply(_to_decimal)
-            _df['dollar_liquidation_buy_volume'] = _df['dollar_liquidation_buy_volume'].apply(_to_decimal)
-            _df['dollar_liquidation_sell_volume'] = _df['dollar_liquidation_sell_volume'].apply(_to_decimal)
-            _df['dollar_cumsum'] = _df['dollar_cumsum'].apply(_to_decimal)
-            _df['dollar_buy_cumsum'] = _df['dollar_buy_cumsum'].appselly(_to_decimal)
-            _df['dollar_sell_cumsum'] = _df['dollar_sell_cumsum'].apply(_to_decimal)
-            return _df.iloc[0]
-        
-        return None
+        # 1行しか使わないのでデータフレームを経由せず直接フェッチする
+        # バーはOHLCV集計値なのでデフォルトはfloat読み(SQL側でdouble precisionにキャスト)とし、Decimalの構築コストを払わない
+        _statement = self._select_statements.get(('latest_bar', _table_name, numeric_as))
+        if _statement is None:
+            if numeric_as == 'float':
+                _select_columns = ', '.join(self._BAR_META_COLUMNS + tuple(f'{_column}::double precision AS {_column}' for _column in self._BAR_NUMERIC_COLUMNS))
+            else:
+                _select_columns = ', '.join(self._BAR_META_COLUMNS + tuple(f'{_column}::text AS {_column}' for _column in self._BAR_NUMERIC_COLUMNS))
+            _statement = text(f'SELECT {_select_columns} FROM "{_table_name}" ORDER BY datetime DESC, id DESC LIMIT 1')
+            self._select_statements[('latest_bar', _table_name, numeric_as)] = _statement
+        with self._engine.connect() as _connection:
+            _row = _connection.execute(_statement).fetchone()
+        if _row is None:
+            return None
+
+        _series = pd.Series(dict(_row))
+        if numeric_as == 'decimal':
+            _series = self._decimalize(_series, self._BAR_NUMERIC_COLUMNS)
+        return _series
 
-    def load_dollarbars(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000, from_str=None, to_str=None):
+    def load_dollarbars(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000, from_str=None, to_str=None, numeric_as='float', chunksize=100_000):
         _table_name = self.get_dollarbar_table_name(exchange, symbol, interval)
-        _sql = f"SELECT * FROM \"{_table_name}\" WHERE datetime >= '{from_str}' AND datetime < '{to_str}' ORDER BY dollar_cumsum ASC"
-        
-        _df = self.read_sql_query(sql = _sql)
-        _df = _df[['datetime', 'open', 'high', 'low', 'close', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume', 'dollar_cumsum', 'dollar_buy_cumsum', 'dollar_sell_cumsum']]
+        # 使う列だけをSELECTし、捨てる列の転送・デコードコストを払わない
+        # デフォルトはfloat読み(SQL側でdouble precisionにキャスト)とし、行数分のDecimal構築コストを払わない
+        # 日時はバインドパラメータで渡し、SQLインジェクションとリテラル違いによる再パースを避ける
+        if numeric_as == 'float':
+            _select_columns = ', '.join([f'{_column}::double precision AS {_column}' if _column in self._BAR_NUMERIC_COLUMNS else _column for _column in self._LOAD_BAR_COLUMNS])
+        else:
+            _select_columns = ', '.join(self._LOAD_BAR_COLUMNS)
+        _sql = text(f'SELECT {_select_columns} FROM "{_table_name}" WHERE datetime >= :from_str AND datetime < :to_str ORDER BY dollar_cumsum ASC')
+
+        _df = self.read_sql_query(sql = _sql, params = {'from_str': from_str, 'to_str': to_str}, chunksize = chunksize)
         return _df
-    
+
+    def load_dollarbars_numba(self, exchange='ftx', symbol='BTC-PERP', interval=5_000_000, from_str=None, to_str=None):
+        """
+        ドルバーをNumba向けの構造化ndarrayで読み込む関数
+        数値列はSQL側でdouble precisionにキャストされたfloat64、datetimeはUNIXエポックナノ秒のint64になり、
+        返り値のrecarrayはそのまま@numba.njit(cache=True, fastmath=True)でコンパイルしたバーごとのループに渡せる
+        パラメータ
+        ----------
+        load_dollarbarsと同じ。
+        返り値
+        -------
+        bars : numpy.recarray
+            float64/int64列のみの構造化配列。
+        """
+        _df = self.load_dollarbars(exchange = exchange, symbol = symbol, interval = interval, from_str = from_str, to_str = to_str, numeric_as = 'float')
+        # タイムゾーン付きのdatetime列はオブジェクト配列になるため、int64のエポックナノ秒に変換する
+        _df['datetime'] = _df['datetime'].astype('int64')
+        return _df.to_records(index = False)
+
     ### タイムバーテーブル関係の処理
-    def get_timebar_table_name(self, exchange, symbol, interval):
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def get_timebar_table_name(exchange, symbol, interval):
         return (f'{exchange}_{symbol}_timebar_{interval}').lower()
 
-    def init_timebar_table(self, exchange='ftx', symbol='BTC-PERP', interval='1h', force=False):    
+    def init_timebar_table(self, exchange='ftx', symbol='BTC-PERP', interval='1h', force=False, chunk_time_interval='30 days'):    
         _table_name = self.get_timebar_table_name(exchange, symbol, interval)
         
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == False and force == False:
+        if self._is_table_exist(_table_name) and not force:
             return
         
         # タイムバー記録テーブルを作成
-        _sql = (f'DROP TABLE IF EXISTS "{_table_name}" CASCADE;'
-                f' CREATE TABLE IF NOT EXISTS "{_table_name}" (datetime TIMESTAMP WITH TIME ZONE NOT NULL, datetime_from TIMESTAMP WITH TIME ZONE NOT NULL, id text, id_from text, open NUMERIC NOT NULL, high NUMERIC NOT NULL, low NUMERIC NOT NULL, close NUMERIC NOT NULL, volume NUMERIC NOT NULL, dollar_volume NUMERIC NOT NULL, dollar_buy_volume NUMERIC NOT NULL, dollar_sell_volume NUMERIC NOT NULL, dollar_liquidation_volume NUMERIC NOT NULL, dollar_liquidation_buy_volume NUMERIC NOT NULL, dollar_liquidation_sell_volume NUMERIC NOT NULL, dollar_cumsum NUMERIC NOT NULL, dollar_buy_cumsum NUMERIC NOT NULL, dollar_sell_cumsum NUMERIC NOT NULL, UNIQUE(datetime));'
-                f' CREATE INDEX ON "{_table_name}" (datetime DESC);'
-                f' CREATE INDEX ON "{_table_name}" (datetime DESC, dollar_cumsum);'
-                f" SELECT create_hypertable ('{_table_name}', 'datetime');")
-        self.sql_execute(_sql)
+        self._init_table(_table_name, self._BAR_TABLE_COLUMNS, ('datetime',), chunk_time_interval)
+
+    def finalize_timebar_table(self, exchange='ftx', symbol='BTC-PERP', interval='1h'):
+        """
+        タイムバーテーブルの二次インデックスを作成する関数
+        一括ロード中の行ごとのインデックス更新を避けるため、バックフィル完了後に呼び出す
+        """
+        _table_name = self.get_timebar_table_name(exchange, symbol, interval)
+        self._create_secondary_index(_table_name)
 
-    def get_latest_timebar(self, exchange='ftx', symbol='BTC-PERP', interval=24*60*60):
+    def get_latest_timebar(self, exchange='ftx', symbol='BTC-PERP', interval=24*60*60, numeric_as='float'):
         _table_name = self.get_timebar_table_name(exchange, symbol, interval)
         
-        _df = self.read_sql_query(f"select * from information_schema.tables where table_name='{_table_name}'")
-        if _df.empty == True:
+        if not self._is_table_exist(_table_name):
             return None
         
-        _df = self.read_sql_query(f'SELECT * FROM "{_table_name}" ORDER BY datetime DESC, id DESC LIMIT 1', dtype={'open': str, 'high': str, 'low': str, 'close': str, 'volume': str, 'dollar_volume': str, 'dollar_buy_volume': str, 'dollar_sell_volume': str, 'dollar_liquidation_buy_volume': str, 'dollar_liquidation_sell_volume': str, 'dollar_cumsum': str})
-        if len(_df) > 0:
-            _to_decimal = lambda x: Decimal(x)
-            _df['open'] = _df['open'].apply(_to_decimal)
-            _df['high'] = _df['high'].apply(_to_decimal)
-            _df['low'] = _df['low'].apply(_to_decimal)
-            _df['close'] = _df['close'].apply(_to_decimal)
-            _df['volume'] = _df['volume'].apply(_to_decimal)
-            _df['dollar_volume'] = _df['dollar_volume'].apply(_to_decimal)
-            _df['dollar_buy_volume'] = _df['dollar_buy_volume'].apply(_to_decimal)
-            _df['dollar_sell_volume'] = _df['dollar_sell_volume'].apply(_to_decimal)
-            _df['dollar_liquidation_volume'] = _df['dollar_liquidation_volume'].apply(_to_decimal)
-            _df['dollar_liquidation_buy_volume'] = _df['dollar_liquidation_buy_volume'].apply(_to_decimal)
-            _df['dollar_liquidation_sell_volume'] = _df['dollar_liquidation_sell_volume'].apply(_to_decimal)
-            _df['dollar_cumsum'] = _df['dollar_cumsum'].apply(_to_decimal)
-            _df['dollar_buy_cumsum'] = _df['dollar_buy_cumsum'].apply(_to_decimal)
-            _df['dollar_sell_cumsum'] = _df['dollar_sell_cumsum'].apply(_to_decimal)
-            return _df.iloc[0]
-        
-        return None
+        # 1行しか使わないのでデータフレームを経由せず直接フェッチする
+        # バーはOHLCV集計値なのでデフォルトはfloat読み(SQL側でdouble precisionにキャスト)とし、Decimalの構築コストを払わない
+        _statement = self._select_statements.get(('latest_bar', _table_name, numeric_as))
+        if _statement is None:
+            if numeric_as == 'float':
+                _select_columns = ', '.join(self._BAR_META_COLUMNS + tuple(f'{_column}::double precision AS {_column}' for _column in self._BAR_NUMERIC_COLUMNS))
+            else:
+                _select_columns = ', '.join(self._BAR_META_COLUMNS + tuple(f'{_column}::text AS {_column}' for _column in self._BAR_NUMERIC_COLUMNS))
+            _statement = text(f'SELECT {_select_columns} FROM "{_table_name}" ORDER BY datetime DESC, id DESC LIMIT 1')
+            self._select_statements[('latest_bar', _table_name, numeric_as)] = _statement
+        with self._engine.connect() as _connection:
+            _row = _connection.execute(_statement).fetchone()
+        if _row is None:
+            return None
+
+        _series = pd.Series(dict(_row))
+        if numeric_as == 'decimal':
+            _series = self._decimalize(_series, self._BAR_NUMERIC_COLUMNS)
+        return _series
     
-    def load_timebars(self, exchange='ftx', symbol='BTC-PERP', interval=24*60*60, from_str=None, to_str=None):
+    def load_timebars(self, exchange='ftx', symbol='BTC-PERP', interval=24*60*60, from_str=None, to_str=None, numeric_as='float', chunksize=100_000):
         _table_name = self.get_timebar_table_name(exchange, symbol, interval)
-        _sql = f"SELECT * FROM \"{_table_name}\" WHERE datetime >= '{from_str}' AND datetime < '{to_str}' ORDER BY dollar_cumsum ASC"
-        
-        _df = self.read_sql_query(sql = _sql)
-        _df = _df[['datetime', 'open', 'high', 'low', 'close', 'dollar_volume', 'dollar_buy_volume', 'dollar_sell_volume', 'dollar_liquidation_buy_volume', 'dollar_liquidation_sell_volume', 'dollar_cumsum', 'dollar_buy_cumsum', 'dollar_sell_cumsum']]
+        # 使う列だけをSELECTし、捨てる列の転送・デコードコストを払わない
+        # デフォルトはfloat読み(SQL側でdouble precisionにキャスト)とし、行数分のDecimal構築コストを払わない
+        # 日時はバインドパラメータで渡し、SQLインジェクションとリテラル違いによる再パースを避ける
+        if numeric_as == 'float':
+            _select_columns = ', '.join([f'{_column}::double precision AS {_column}' if _column in self._BAR_NUMERIC_COLUMNS else _column for _column in self._LOAD_BAR_COLUMNS])
+        else:
+            _select_columns = ', '.join(self._LOAD_BAR_COLUMNS)
+        _sql = text(f'SELECT {_select_columns} FROM "{_table_name}" WHERE datetime >= :from_str AND datetime < :to_str ORDER BY dollar_cumsum ASC')
+
+        _df = self.read_sql_query(sql = _sql, params = {'from_str': from_str, 'to_str': to_str}, chunksize = chunksize)
         return _df